@@ -0,0 +1,95 @@
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from urllib.parse import urlparse
+from urllib.request import urlopen
+import pytest
+
+try:
+    from filelock import FileLock
+except ImportError:
+    # Without filelock, parallel workers may download the same URL twice,
+    # but the per-process .part file plus atomic rename keeps the cache valid.
+    from contextlib import nullcontext as FileLock
+
+
+__author__ = "Martin Maly"
+__maintainer__ = "Martin Maly"
+__email__ = "martin.maly@mrc-lmb.cam.ac.uk"
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--cif-cache",
+        default=None,
+        help="Directory with pre-downloaded {code}.cif[.gz] files; "
+             "when set, the tests read from it instead of downloading from RCSB",
+    )
+
+
+@pytest.fixture(scope="session")
+def classify_exe():
+    """Resolve the classify_and_write_cif executable once per session."""
+    exe = shutil.which("classify_and_write_cif")
+    if exe is None:
+        pytest.skip("classify_and_write_cif executable not found in PATH")
+    return exe
+
+
+@pytest.fixture(scope="session")
+def dnatco_exe():
+    """Resolve the dnatco executable once per session."""
+    exe = shutil.which("dnatco")
+    if exe is None:
+        pytest.skip("dnatco executable not found in PATH")
+    return exe
+
+
+@pytest.fixture(scope="session")
+def cached_cif(request):
+    """
+    Returns a function that downloads a file from a URL into a persistent
+    cache directory (kept across pytest invocations via the pytest cache)
+    and returns a string path to the cached file.
+    Files are keyed by the SHA1 hash of the URL so each URL is downloaded
+    at most once; repeated runs reuse the cached copy.
+    """
+    cachedir = Path(request.config.cache.mkdir("rcsb"))
+
+    def _fetch(url: str) -> str:
+        key = hashlib.sha1(url.encode()).hexdigest()
+        path = cachedir / f"{key}_{os.path.basename(urlparse(url).path)}"
+        if not path.exists():
+            with FileLock(str(path) + ".lock"):
+                if not path.exists():
+                    part = path.with_name(f"{path.name}.{os.getpid()}.part")
+                    with urlopen(url, timeout=30) as response, open(part, "wb") as temp:
+                        shutil.copyfileobj(response, temp, length=1024 * 1024)
+                    os.replace(part, path)
+        return str(path)
+
+    return _fetch
+
+
+@pytest.fixture(scope="session")
+def cif_path(request, cached_cif):
+    """
+    Returns a function that resolves a PDB code and its download URL to a
+    local file path. With --cif-cache=<dir>, the file is read directly from
+    that directory and no network access happens; otherwise it is fetched
+    through the cached_cif download cache.
+    """
+    cif_cache = request.config.getoption("--cif-cache")
+
+    def _resolve(pdb_code: str, url: str) -> str:
+        if cif_cache:
+            for suffix in (".cif", ".cif.gz"):
+                path = Path(cif_cache) / f"{pdb_code}{suffix}"
+                if path.exists():
+                    return str(path)
+            raise FileNotFoundError(
+                f"{pdb_code}.cif[.gz] not found in --cif-cache directory {cif_cache}")
+        return cached_cif(url)
+
+    return _resolve
@@ -1,4 +1,7 @@
+import hashlib
 import os
+import re
+import shutil
 import subprocess
 from pathlib import Path
 import gemmi
@@ -22,9 +25,15 @@ __email__ = "martin.maly@mrc-lmb.cam.ac.uk"
 _RCSB = "https://files.rcsb.org"
 _REDO = "https://pdb-redo.eu/db"
 
+_SANITIZE_RE = re.compile(r"[^A-Za-z0-9._-]")
+
 
 def rcsb_mmcif(code: str):
-    return f"{_RCSB}/download/{code}.cif"
+    return f"{_RCSB}/download/{code}.cif.gz"
+
+
+def rcsb_bcif(code: str):
+    return f"{_RCSB}/download/{code}.bcif"
 
 
 def redo_cif(code: str):
@@ -46,10 +55,9 @@ def download(url: str):
     with urlopen(url, timeout=30) as response:
         name = response.headers.get_filename() or urlName
         name = name.strip().replace(" ", "_")
-        name = "".join(c for c in name if c.isalnum() or c in "-_.")
+        name = _SANITIZE_RE.sub("", name)
         with NamedTemporaryFile(suffix=f"_{name}", delete=False) as temp:
-            while chunk := response.read(1_000_000):
-                temp.write(chunk)
+            shutil.copyfileobj(response, temp, length=1024 * 1024)
         path = Path(temp.name).resolve()
         try:
             yield str(path)
@@ -57,34 +65,49 @@ def download(url: str):
             path.unlink(missing_ok=True)
 
 
-def check_mmcif_overall_tags(block: gemmi.cif.Block, expected_tags: list[str]) -> bool:
-    """Check that all expected tags exist in the mmcif block"""
-    for tag_label in expected_tags:
-        tag_label_full = f"_ndb_struct_ntc_overall.{tag_label}"
-        assert block.find_pair(tag_label_full), f"Missing tag: {tag_label_full}"
+def table_digest(table: gemmi.cif.Table) -> bytes:
+    """Hash all cells of a table, column by column, into a single digest"""
+    digest = hashlib.blake2b()
+    for i in range(table.width()):
+        for value in table.column(i):
+            digest.update(value.encode())
+            digest.update(b"\0")
+    return digest.digest()
+
+
+def check_mmcif_overall_tags(block: gemmi.cif.Block) -> bool:
+    """Check that all expected _ndb_struct_ntc_overall tags exist in the mmcif block in one pass"""
+    missing = set(OVERALL_TAGS_FULL)
+    for item in block:
+        if item.pair is not None:
+            missing.discard(item.pair[0])
+    assert not missing, f"Missing tags: {sorted(missing)}"
 
 
 def check_mmcif_table_columns(
         block: gemmi.cif.Block,
         table_name: str,
         expected_columns: list[str],
-        expected_ntc_steps_table="") -> bool:
+        block_expected: gemmi.cif.Block = None) -> bool:
     """
     Check that a loop exists and contains all expected columns.
-    If expected_ntc_steps_table is provided, also compare the content of the table.
+    If block_expected is provided, also compare the content of the table.
     """
+    table = block.find(table_name, expected_columns)
+    assert table, f"Missing table: {table_name}"
+
     for loop_label in expected_columns:
         loop_label_full = f"{table_name}{loop_label}"
         assert block.find_loop(loop_label_full), f"Missing loop tag: {loop_label_full}"
 
-        table = block.find(table_name, expected_columns)
-        assert table, f"Missing table: {table_name}"
-
-        if expected_ntc_steps_table and table_name == "_ndb_struct_ntc_step.":
-            block_expected = gemmi.cif.read_string(expected_ntc_steps_table)[0]
-            table_expected = block_expected.find(table_name, expected_columns)
-            for row_actual, row_expected in zip(table, table_expected):
-                assert list(row_actual) == list(row_expected), f"Mismatch in ntc_steps_table at row: {row_actual}"
+    if block_expected is not None and table_name == "_ndb_struct_ntc_step.":
+        table_expected = block_expected.find(table_name, expected_columns)
+        if table_digest(table) != table_digest(table_expected):
+            rows_actual = [tuple(row) for row in table]
+            rows_expected = [tuple(row) for row in table_expected]
+            for row_actual, row_expected in zip(rows_actual, rows_expected):
+                assert row_actual == row_expected, f"Mismatch in ntc_steps_table at row: {row_actual}"
+            assert len(rows_actual) == len(rows_expected), "Mismatch in ntc_steps_table length"
 
 
 def check_dnatco_extended_mmcif(
@@ -97,22 +120,14 @@ def check_dnatco_extended_mmcif(
 
     # Check that the mmcif output contains the expected tags
     block = output[0]
-    overall_tags = [
-        "entry_id",
-        "confal_score",
-        "confal_percentile",
-        "ntc_version",
-        "cana_version",
-        "num_steps",
-        "num_classified",
-        "num_unclassified",
-        "num_unclassified_rmsd_close",
-    ]
-    check_mmcif_overall_tags(block, overall_tags)
+    check_mmcif_overall_tags(block)
 
     # Check tables and their columns
-    for table, columns in expected_loops.items():
-        check_mmcif_table_columns(block, table, columns, expected_ntc_steps_table)
+    block_expected = None
+    if expected_ntc_steps_table:
+        block_expected = gemmi.cif.read_string(expected_ntc_steps_table)[0]
+    for table, columns in EXPECTED_LOOPS.items():
+        check_mmcif_table_columns(block, table, columns, block_expected)
 
     # Check pairs with expected values
     for tag, value in expected_values_minimal.items():
@@ -306,7 +321,20 @@ param_vals = [
 ]
 param_ids = ['3A3A', '5JZQ', '9BKD']
 
-expected_loops = {
+OVERALL_TAGS = (
+    "entry_id",
+    "confal_score",
+    "confal_percentile",
+    "ntc_version",
+    "cana_version",
+    "num_steps",
+    "num_classified",
+    "num_unclassified",
+    "num_unclassified_rmsd_close",
+)
+OVERALL_TAGS_FULL = tuple(f"_ndb_struct_ntc_overall.{tag_label}" for tag_label in OVERALL_TAGS)
+
+EXPECTED_LOOPS = {
     "_ndb_struct_ntc_step.":
     [
         "id",
@@ -425,20 +453,23 @@ def test_classify_and_write_cif(
     expected_values_precise: dict,
     expected_ntc_steps_table: str,
     expected_restraint: str,
+    classify_exe,
+    cif_path,
 ):
     expected_restraint = 0  # Not generated and tested here
-    executable = "classify_and_write_cif"
-    with download(rcsb_mmcif(pdb_code)) as ciffile:
+    executable = classify_exe
+    ciffile = cif_path(pdb_code, rcsb_mmcif(pdb_code))
+    with NamedTemporaryFile(suffix=f"_{pdb_code}_out.cif") as temp_out:
         result = subprocess.run(
             [str(executable), str(ciffile)],
-            capture_output=True,
-            text=True,
+            stdout=temp_out,
+            stderr=subprocess.PIPE,
             check=True,
         )
 
-    assert result.returncode == 0
-    assert result.stderr == ""
-    output = gemmi.cif.read_string(result.stdout)
+        assert result.returncode == 0
+        assert result.stderr == b""
+        output = gemmi.cif.read(temp_out.name)
     check_dnatco_extended_mmcif(output, expected_values_minimal, expected_values_precise,
                                 expected_ntc_steps_table)
 
@@ -454,26 +485,27 @@ def test_dnatco_nodejs(
     expected_values_precise: dict,
     expected_ntc_steps_table: str,
     expected_restraint: str,
+    dnatco_exe,
+    cif_path,
 ):
-    executable = "dnatco"
-    with download(rcsb_mmcif(pdb_code)) as ciffile:
-        result = subprocess.run(
-            [str(executable),
-             "--coords", str(ciffile),
-             "--outputDir", ".",
-             "--extendedCIF",
-             "--refmacRestraints",
-             "--restraintsRmsd", "0.5",
-             "--restraintsSigmaFactor", "1",
-             "--prefix", f"{pdb_code}_dnatco"
-             ],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
+    executable = dnatco_exe
+    ciffile = cif_path(pdb_code, rcsb_mmcif(pdb_code))
+    result = subprocess.run(
+        [str(executable),
+         "--coords", str(ciffile),
+         "--outputDir", ".",
+         "--extendedCIF",
+         "--refmacRestraints",
+         "--restraintsRmsd", "0.5",
+         "--restraintsSigmaFactor", "1",
+         "--prefix", f"{pdb_code}_dnatco"
+         ],
+        capture_output=True,
+        check=True,
+    )
 
     assert result.returncode == 0
-    assert result.stderr == ""
+    assert result.stderr == b""
     output = gemmi.cif.read_file(f"{pdb_code}_dnatco_extended.cif")
     check_dnatco_extended_mmcif(output, expected_values_minimal, expected_values_precise,
                                 expected_ntc_steps_table)